@@ -5,12 +5,58 @@ USearch 性能基准测试脚本
 """
 
 import numpy as np
-import usearch
+from usearch.index import Index
 import time
+import matplotlib
+matplotlib.use('Agg')  # 无界面后端：只写文件，不依赖显示服务
 import matplotlib.pyplot as plt
 from typing import Dict, List, Tuple
-import psutil
 import os
+import gc
+import argparse
+import tempfile
+
+# 可选依赖：有 Numba 时对召回率统计做 JIT 编译
+try:
+    import numba
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+def quantize_i8(vectors):
+    """逐向量对称标量量化到 int8
+
+    每行按自身最大绝对值缩放到 [-127, 127]。缩放系数是正数，
+    不改变向量方向，因此余弦距离在量化前后保持一致。
+    """
+    scale = np.abs(vectors).max(axis=1, keepdims=True) / 127
+    scale[scale == 0] = 1
+    return np.clip(np.round(vectors / scale), -127, 127).astype(np.int8)
+
+
+if NUMBA_AVAILABLE:
+    @numba.njit
+    def count_hits(retrieved, ground_truth):
+        """统计每个查询的检索结果中命中真实近邻的个数
+
+        逐元素比较并提前退出，不生成 (n_queries, k, k) 的布尔临时数组
+        """
+        hits = np.zeros(retrieved.shape[0], dtype=np.int64)
+        for i in range(retrieved.shape[0]):
+            for a in range(retrieved.shape[1]):
+                for b in range(ground_truth.shape[1]):
+                    if retrieved[i, a] == ground_truth[i, b]:
+                        hits[i] += 1
+                        break
+        return hits
+else:
+    def count_hits(retrieved, ground_truth):
+        """统计每个查询的检索结果中命中真实近邻的个数
+
+        retrieved 和 ground_truth 均为 (n_queries, k) 的 int64 数组
+        """
+        return (retrieved[:, :, None] == ground_truth[:, None, :]).any(axis=2).sum(axis=1)
 
 
 class PerformanceBenchmark:
@@ -20,20 +66,47 @@ class PerformanceBenchmark:
         self.dimensions = dimensions
         self.results = {}
 
-    def generate_vectors(self, n_vectors, seed=42):
-        """生成测试向量"""
-        np.random.seed(seed)
-        return np.random.rand(n_vectors, self.dimensions).astype(np.float32)
+    def generate_vectors(self, n_vectors, seed=42, path=None):
+        """生成测试向量
+
+        直接以 float32 采样，避免先生成 float64 再转换带来的双倍内存。
+        指定 path 时写入内存映射文件，数据不占用进程的匿名堆内存；
+        但映射页被访问后仍计入 RSS，且临时目录常为 tmpfs（内存文件系统），
+        此时这些页并不能被内核回收到磁盘
+        """
+        rng = np.random.default_rng(seed)
+        shape = (n_vectors, self.dimensions)
+        if path is None:
+            return rng.random(shape, dtype=np.float32)
+
+        vectors = np.memmap(path, dtype=np.float32, mode='w+', shape=shape)
+        rng.random(shape, dtype=np.float32, out=vectors)
+        vectors.flush()
+        return vectors
+
+    def build_index(self, vectors, connectivity=16, expansion=200):
+        """用固定参数构建索引，供搜索和召回率测试共用"""
+        index = Index(
+            ndim=self.dimensions,
+            metric='cos',
+            connectivity=connectivity,
+            expansion_add=expansion
+        )
+
+        keys = np.arange(len(vectors), dtype=np.uint64)
+        index.add(keys, vectors, threads=os.cpu_count())
+        return index
 
-    def benchmark_indexing(self, n_vectors=100000, connectivities=[8, 16, 32],
+    def benchmark_indexing(self, vectors, connectivities=[8, 16, 32],
                           ef_constructions=[100, 200, 400]):
         """基准测试：索引构建"""
         print("=" * 60)
         print("索引构建性能测试")
         print("=" * 60)
 
-        vectors = self.generate_vectors(n_vectors)
+        n_vectors = len(vectors)
         keys = np.arange(n_vectors, dtype=np.uint64)
+        threads = os.cpu_count()
 
         results = []
 
@@ -41,87 +114,100 @@ class PerformanceBenchmark:
             for ef_const in ef_constructions:
                 print(f"\n测试: M={M}, ef_construction={ef_const}")
 
-                index = usearch.Index(
+                index = Index(
                     ndim=self.dimensions,
                     metric='cos',
                     connectivity=M,
-                    expansion=ef_const
+                    expansion_add=ef_const
                 )
 
-                # 测量构建时间
-                start_time = time.time()
-                index.add(keys, vectors)
-                build_time = time.time() - start_time
-
-                # 测量内存使用
-                process = psutil.Process(os.getpid())
-                memory_mb = process.memory_info().rss / 1024 / 1024
+                # 测量构建时间（关闭 GC，避免回收停顿混入计时）
+                gc.disable()
+                try:
+                    start_time = time.perf_counter()
+                    start_cpu = time.process_time()
+                    index.add(keys, vectors, threads=threads)
+                    cpu_time = time.process_time() - start_cpu
+                    build_time = time.perf_counter() - start_time
+                finally:
+                    gc.enable()
+
+                # 测量内存使用：以索引自身统计的字节数为准。进程 RSS 差值会因
+                # 分配器复用上一轮释放的页而偏低，且混入输入向量等其他对象
+                memory_mb = index.memory_usage / 1024 / 1024
 
                 result = {
                     'M': M,
                     'ef_construction': ef_const,
                     'build_time': build_time,
+                    'cpu_time': cpu_time,
+                    'parallel_efficiency': cpu_time / (build_time * threads),
                     'throughput': n_vectors / build_time,
                     'memory_mb': memory_mb
                 }
 
                 results.append(result)
 
-                print(f"  构建时间: {build_time:.2f}s")
+                print(f"  构建时间: {build_time:.2f}s (CPU {cpu_time:.2f}s, "
+                      f"并行效率 {result['parallel_efficiency']:.0%})")
                 print(f"  吞吐量: {result['throughput']:.0f} vectors/s")
                 print(f"  内存使用: {memory_mb:.1f} MB")
 
+                # 释放本轮索引，不与下一轮的索引同时占用内存
+                del index
+
         self.results['indexing'] = results
         return results
 
-    def benchmark_search(self, n_vectors=100000, n_queries=1000,
+    def benchmark_search(self, vectors, queries,
                         ef_values=[16, 32, 64, 128, 256],
-                        k=10):
-        """基准测试：搜索性能"""
+                        k=10, n_batches=32, index=None):
+        """基准测试：搜索性能
+
+        索引结构与 ef 无关，可通过 index 传入已构建好的索引复用
+        """
         print("\n" + "=" * 60)
         print("搜索性能测试")
         print("=" * 60)
 
-        # 构建索引（使用固定参数）
-        index = usearch.Index(
-            ndim=self.dimensions,
-            metric='cos',
-            connectivity=16,
-            expansion=200
-        )
+        n_queries = len(queries)
+        # 批次数不超过查询数，避免切出空批次
+        n_batches = max(1, min(n_batches, n_queries))
 
-        vectors = self.generate_vectors(n_vectors)
-        queries = self.generate_vectors(n_queries, seed=123)
-
-        keys = np.arange(n_vectors, dtype=np.uint64)
-        index.add(keys, vectors)
+        if index is None:
+            index = self.build_index(vectors)
 
         results = []
 
         for ef in ef_values:
             print(f"\n测试: ef={ef}")
 
-            index.expansion = ef
+            # Python 绑定的 search() 不接受逐次调用的 ef 参数，
+            # 因此在计时前设置一次 expansion_search，并用预热查询把
+            # 可能的延迟初始化隔离在计时区间之外
+            index.expansion_search = ef
 
             # 预热
-            index.search(queries[0], k)
+            index.search(queries[:1], k)
 
-            # 测试搜索
-            latencies = []
-            start_time = time.time()
+            # 测试搜索：按批提交查询，由 USearch 在内部并行处理，
+            # 每个查询的延迟取所在批次耗时的均摊值
+            # 计时保持整数纳秒，统计时再统一换算成毫秒
+            latencies_ns = []
+            total_ns = 0
 
-            for query in queries:
-                q_start = time.time()
-                index.search(query, k)
-                latencies.append(time.time() - q_start)
+            for batch in np.array_split(queries, n_batches):
+                batch_start = time.perf_counter_ns()
+                index.search(batch, k, threads=os.cpu_count())
+                batch_ns = time.perf_counter_ns() - batch_start
 
-            total_time = time.time() - start_time
+                total_ns += batch_ns
+                latencies_ns.extend([batch_ns / len(batch)] * len(batch))
 
-            avg_latency = np.mean(latencies) * 1000  # ms
-            p50_latency = np.percentile(latencies, 50) * 1000
-            p95_latency = np.percentile(latencies, 95) * 1000
-            p99_latency = np.percentile(latencies, 99) * 1000
-            qps = n_queries / total_time
+            latencies_ms = np.asarray(latencies_ns) / 1e6
+            avg_latency = latencies_ms.mean()
+            p50_latency, p95_latency, p99_latency = np.percentile(latencies_ms, [50, 95, 99])
+            qps = n_queries / (total_ns / 1e9)
 
             result = {
                 'ef': ef,
@@ -141,58 +227,55 @@ class PerformanceBenchmark:
         self.results['search'] = results
         return results
 
-    def benchmark_accuracy(self, n_vectors=10000, n_queries=100,
-                          k=10, ef_values=[16, 32, 64, 128]):
-        """基准测试：召回率"""
+    def benchmark_accuracy(self, vectors, n_queries=100,
+                          k=10, ef_values=[16, 32, 64, 128], index=None):
+        """基准测试：召回率
+
+        index 须基于同一组 vectors 构建，键为行号
+        """
         print("\n" + "=" * 60)
         print("召回率测试")
         print("=" * 60)
 
-        vectors = self.generate_vectors(n_vectors)
         queries = vectors[:n_queries]  # 使用前 n_queries 个作为查询
-        ground_truth = []
 
         # 计算真实最近邻（暴力搜索）
+        # 索引使用余弦距离：用一次矩阵乘法 (GEMM) 得到全部查询的点积，
+        # 再除以范数。范数由 einsum 融合平方和求得，不生成 (n, d) 的临时数组，
+        # 也不必复制出一份归一化后的向量矩阵
         print("计算真实最近邻...")
-        for query in queries:
-            distances = np.linalg.norm(vectors - query, axis=1)
-            nearest = np.argsort(distances)[:k]
-            ground_truth.append(set(nearest))
+        norms = np.sqrt(np.einsum('ij,ij->i', vectors, vectors))
+        similarities = queries @ vectors.T
+        similarities /= norms[:n_queries, None] * norms[None, :]
+        # argpartition 只做 O(n) 的选择而非完整排序；召回率按集合计算，
+        # 前 k 个内部无需有序。kth 取 k - 1，使 k == n_vectors 时同样有效
+        ground_truth = np.ascontiguousarray(
+            np.argpartition(-similarities, k - 1, axis=1)[:, :k], dtype=np.int64)
 
         # 构建 USearch 索引
-        index = usearch.Index(
-            ndim=self.dimensions,
-            metric='cos',
-            connectivity=16,
-            expansion=200
-        )
-
-        keys = np.arange(n_vectors, dtype=np.uint64)
-        index.add(keys, vectors)
+        if index is None:
+            index = self.build_index(vectors)
 
         results = []
 
         for ef in ef_values:
             print(f"\n测试: ef={ef}")
-            index.expansion = ef
+            index.expansion_search = ef
 
-            recalls = []
-            for i, query in enumerate(queries):
-                results_search = index.search(query, k)
-                retrieved = set([key for key, _ in results_search])
+            matches = index.search(queries, k)
 
-                # 计算召回率
-                intersection = retrieved & ground_truth[i]
-                recall = len(intersection) / k
-                recalls.append(recall)
+            # 计算召回率：逐行广播比较检索结果与真实近邻，一次完成全部查询
+            retrieved = np.ascontiguousarray(matches.keys, dtype=np.int64)
+            hits = count_hits(retrieved, ground_truth)
+            recalls = hits / k
 
-            avg_recall = np.mean(recalls)
+            avg_recall = recalls.mean()
 
             result = {
                 'ef': ef,
                 'avg_recall': avg_recall,
-                'min_recall': np.min(recalls),
-                'max_recall': np.max(recalls)
+                'min_recall': recalls.min(),
+                'max_recall': recalls.max()
             }
 
             results.append(result)
@@ -204,55 +287,52 @@ class PerformanceBenchmark:
         self.results['accuracy'] = results
         return results
 
-    def benchmark_quantization(self, n_vectors=100000, n_queries=1000,
-                               scalar_types=['f32', 'f16', 'i8']):
+    def benchmark_quantization(self, vectors, queries,
+                               scalar_types=['f32', 'f16', 'i8'], n_batches=10):
         """基准测试：量化效果"""
         print("\n" + "=" * 60)
         print("量化性能测试")
         print("=" * 60)
 
-        vectors = self.generate_vectors(n_vectors)
-        queries = self.generate_vectors(n_queries, seed=123)
+        n_vectors = len(vectors)
+        keys = np.arange(n_vectors, dtype=np.uint64)
 
         results = []
 
         for scalar in scalar_types:
             print(f"\n测试: {scalar}")
 
-            index = usearch.Index(
+            index = Index(
                 ndim=self.dimensions,
                 metric='cos',
                 dtype=scalar,
                 connectivity=16
             )
 
-            keys = np.arange(n_vectors, dtype=np.uint64)
+            # 转换为目标标量类型，让 USearch 直接接收对应精度的数据
+            if scalar == 'f16':
+                data, data_queries = vectors.astype(np.float16), queries.astype(np.float16)
+            elif scalar == 'i8':
+                data, data_queries = quantize_i8(vectors), quantize_i8(queries)
+            else:
+                data, data_queries = vectors, queries
 
             # 构建索引
-            start_time = time.time()
-            if scalar == 'f32':
-                index.add(keys, vectors)
-            else:
-                # 转换类型
-                if scalar == 'f16':
-                    import numpy_half
-                    vectors_half = vectors.astype(np.float16)
-                    index.add(keys, vectors_half.view(np.float32))
-                elif scalar == 'i8':
-                    # 简化：使用 f32 代替（实际应该量化）
-                    index.add(keys, vectors)
-
-            build_time = time.time() - start_time
-
-            # 搜索
-            latencies = []
-            for query in queries[:100]:  # 只测试 100 个查询
-                q_start = time.time()
-                if scalar == 'f32':
-                    index.search(query, 10)
-                latencies.append(time.time() - q_start)
-
-            avg_latency = np.mean(latencies) * 1000
+            start_time = time.perf_counter()
+            index.add(keys, data)
+            build_time = time.perf_counter() - start_time
+
+            # 搜索：所有标量类型都实际执行查询（只测试 100 个查询）。
+            # 按小批次计时，用单调的纳秒计时器均摊计时开销
+            timed_queries = data_queries[:100]
+            latencies_ns = []
+            for batch in np.array_split(timed_queries, max(1, min(n_batches, len(timed_queries)))):
+                batch_start = time.perf_counter_ns()
+                index.search(batch, 10)
+                batch_ns = time.perf_counter_ns() - batch_start
+                latencies_ns.extend([batch_ns / len(batch)] * len(batch))
+
+            avg_latency = np.mean(latencies_ns) / 1e6  # ms
 
             # 内存估算
             memory_per_vector = {
@@ -278,8 +358,8 @@ class PerformanceBenchmark:
         self.results['quantization'] = results
         return results
 
-    def plot_results(self):
-        """绘制结果图表"""
+    def plot_results(self, save_path='benchmark_results.png', dpi=150):
+        """绘制结果图表并保存到文件"""
         if not self.results:
             print("没有可绘制的测试结果")
             return
@@ -359,8 +439,9 @@ class PerformanceBenchmark:
             ax.grid(True, alpha=0.3)
 
         plt.tight_layout()
-        plt.savefig('benchmark_results.png', dpi=300, bbox_inches='tight')
-        plt.show()
+        fig.savefig(save_path, dpi=dpi, bbox_inches='tight')
+        plt.close(fig)
+        print(f"\n图表已保存到 {save_path}")
 
     def print_summary(self):
         """打印测试总结"""
@@ -394,44 +475,76 @@ class PerformanceBenchmark:
 
 def main():
     """运行完整的基准测试"""
+    parser = argparse.ArgumentParser(description='USearch 性能基准测试')
+    parser.add_argument('--no-plot', action='store_true',
+                        help='跳过绘图')
+    parser.add_argument('--plot-path', default='benchmark_results.png',
+                        help='图表保存路径 (默认: benchmark_results.png)')
+    parser.add_argument('--dpi', type=int, default=150,
+                        help='图表分辨率 (默认: 150)')
+    parser.add_argument('--mmap', action='store_true',
+                        help='将测试向量写入临时文件并内存映射，不占用匿名堆内存')
+    args = parser.parse_args()
+
     print("USearch 性能基准测试")
     print("=" * 60)
 
     # 创建测试实例
     benchmark = PerformanceBenchmark(dimensions=128)
 
-    # 运行测试
-    # 1. 索引构建测试
-    benchmark.benchmark_indexing(
-        n_vectors=10000,
-        connectivities=[8, 16, 32],
-        ef_constructions=[100, 200]
-    )
-
-    # 2. 搜索性能测试
-    benchmark.benchmark_search(
-        n_vectors=10000,
-        n_queries=1000,
-        ef_values=[16, 32, 64, 128],
-        k=10
-    )
-
-    # 3. 召回率测试
-    benchmark.benchmark_accuracy(
-        n_vectors=10000,
-        n_queries=100,
-        k=10,
-        ef_values=[16, 32, 64, 128]
-    )
-
-    # 4. 量化测试（可选）
-    # benchmark.benchmark_quantization(n_vectors=10000, n_queries=100)
-
-    # 绘制结果
-    benchmark.plot_results()
-
-    # 打印总结
-    benchmark.print_summary()
+    # 测试数据只生成一次，各阶段复用（不同规模时用切片视图，零拷贝）
+    vectors_path = None
+    if args.mmap:
+        vectors_path = os.path.join(tempfile.gettempdir(), f'usearch_bench_{os.getpid()}.f32')
+    vectors = shared_index = None
+    try:
+        vectors = benchmark.generate_vectors(10000, path=vectors_path)
+        queries = benchmark.generate_vectors(1000, seed=123)
+
+        # 搜索和召回率测试使用相同的数据和构建参数，只构建一次索引
+        shared_index = benchmark.build_index(vectors)
+
+        # 运行测试
+        # 1. 索引构建测试
+        benchmark.benchmark_indexing(
+            vectors,
+            connectivities=[8, 16, 32],
+            ef_constructions=[100, 200]
+        )
+
+        # 2. 搜索性能测试
+        benchmark.benchmark_search(
+            vectors,
+            queries,
+            ef_values=[16, 32, 64, 128],
+            k=10,
+            index=shared_index
+        )
+
+        # 3. 召回率测试
+        benchmark.benchmark_accuracy(
+            vectors,
+            n_queries=100,
+            k=10,
+            ef_values=[16, 32, 64, 128],
+            index=shared_index
+        )
+
+        # 4. 量化测试（可选）
+        # benchmark.benchmark_quantization(vectors, queries[:100])
+
+        # 绘制结果
+        if not args.no_plot:
+            benchmark.plot_results(save_path=args.plot_path, dpi=args.dpi)
+
+        # 打印总结
+        benchmark.print_summary()
+    finally:
+        # 任一阶段抛出异常也要删除临时映射文件
+        if vectors_path is not None:
+            del shared_index, vectors
+            if os.path.exists(vectors_path):
+                os.remove(vectors_path)
 
 
 if __name__ == '__main__':
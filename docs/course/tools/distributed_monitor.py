@@ -9,15 +9,17 @@
 - 告警通知
 
 依赖：
-- pip install matplotlib psutil flask prometheus-client
+- pip install numpy matplotlib psutil flask prometheus-client
 """
 
 import time
+import numpy as np
 import psutil
 import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, as_completed
 from collections import defaultdict
-from dataclasses import dataclass
-from datetime import datetime, timedelta
+from dataclasses import dataclass, field
+from datetime import datetime
 from typing import Dict, List, Optional
 import json
 import requests
@@ -28,6 +30,8 @@ import sys
 try:
     import matplotlib.pyplot as plt
     import matplotlib.dates as mdates
+    from matplotlib.collections import LineCollection
+    from matplotlib.colors import Normalize
     from matplotlib.animation import FuncAnimation
     MATPLOTLIB_AVAILABLE = True
 except ImportError:
@@ -42,6 +46,39 @@ except ImportError:
     FLASK_AVAILABLE = False
     print("Warning: Flask not available. Web UI will be disabled.")
 
+# 时间序列保留时长（秒）
+HISTORY_SECONDS = 3600
+# 计算 QPS 的滑动窗口（秒）
+QPS_WINDOW_SECONDS = 60
+# 时间序列图中每条曲线最多绘制的点数
+MAX_PLOT_POINTS = 500
+# 每个分片保留的最近延迟样本数（用于估计分位数）
+LATENCY_SAMPLES = 1024
+# 每轮拉取分片指标的总超时（秒），超时未返回的分片记为失败
+FETCH_TIMEOUT_SECONDS = 2
+
+
+class LatencyReservoir:
+    """定长环形缓冲区，保存最近的单次查询延迟样本"""
+
+    def __init__(self, capacity: int = LATENCY_SAMPLES):
+        self.samples = np.empty(capacity, dtype=np.float64)
+        self.head = 0  # 累计写入次数
+
+    def __len__(self) -> int:
+        return min(self.head, len(self.samples))
+
+    def extend(self, latencies_ms):
+        """写入一批样本，超出容量时覆盖最旧的样本"""
+        latencies_ms = np.asarray(latencies_ms, dtype=np.float64)[-len(self.samples):]
+        positions = (self.head + np.arange(len(latencies_ms))) % len(self.samples)
+        self.samples[positions] = latencies_ms
+        self.head += len(latencies_ms)
+
+    def values(self) -> np.ndarray:
+        """返回当前保存的样本（无序）"""
+        return self.samples[:len(self)]
+
 
 @dataclass
 class ShardMetrics:
@@ -54,6 +91,7 @@ class ShardMetrics:
     cpu_percent: float = 0.0
     memory_mb: float = 0.0
     last_update: Optional[datetime] = None
+    latency_samples: LatencyReservoir = field(default_factory=LatencyReservoir, repr=False)
 
     @property
     def avg_latency_ms(self) -> float:
@@ -62,6 +100,33 @@ class ShardMetrics:
         return self.total_latency_ms / self.query_count
 
 
+class TimeSeries:
+    """定长环形缓冲区，时间戳和数值分别存放在连续的 NumPy 数组中"""
+
+    def __init__(self, capacity: int):
+        self.ts = np.empty(capacity, dtype='datetime64[ns]')
+        self.val = np.empty(capacity, dtype=np.float64)
+        self.head = 0  # 累计写入次数
+
+    def __len__(self) -> int:
+        return min(self.head, len(self.val))
+
+    def append(self, timestamp: datetime, value: float):
+        """写入一个数据点，缓冲区满时覆盖最旧的数据"""
+        i = self.head % len(self.val)
+        self.ts[i] = np.datetime64(timestamp, 'ns')
+        self.val[i] = value
+        self.head += 1
+
+    def arrays(self) -> tuple:
+        """按时间顺序返回 (时间戳, 数值) 数组"""
+        capacity = len(self.val)
+        if self.head <= capacity:
+            return self.ts[:self.head], self.val[:self.head]
+        i = self.head % capacity
+        return np.roll(self.ts, -i), np.roll(self.val, -i)
+
+
 @dataclass
 class ClusterMetrics:
     """集群指标"""
@@ -75,22 +140,49 @@ class ClusterMetrics:
 class ClusterMonitor:
     """集群监控器"""
 
-    def __init__(self, shard_addresses: List[str]):
+    def __init__(self, shard_addresses: List[str], seed: int = 0):
         self.shard_addresses = shard_addresses
         self.shards: Dict[int, ShardMetrics] = {}
-        self.history: Dict[str, List[tuple]] = defaultdict(list)  # 时间序列数据
+        self.history: Dict[str, TimeSeries] = self._new_history(interval_seconds=5)  # 时间序列数据
 
         # 初始化分片指标
         for i, addr in enumerate(shard_addresses):
             self.shards[i] = ShardMetrics(shard_id=i)
 
+        # 模拟数据的随机源：由同一种子派生出每个分片独立的生成器
+        # （Generator 不是线程安全的，各分片在线程池中并发拉取）
+        self._rngs = [np.random.default_rng(s)
+                      for s in np.random.SeedSequence(seed).spawn(len(shard_addresses))]
+
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._session: Optional[requests.Session] = None
+        self._open_clients()
+
         self._start_time = datetime.now()
         self._running = False
 
+    @staticmethod
+    def _new_history(interval_seconds: int) -> Dict[str, TimeSeries]:
+        """创建定长的时间序列缓冲区，超出保留时长的旧数据自动淘汰"""
+        capacity = max(HISTORY_SECONDS // max(interval_seconds, 1), 1)
+        return defaultdict(lambda: TimeSeries(capacity))
+
+    def _open_clients(self):
+        """创建并发拉取用的线程池和 HTTP Session（stop 后再次 start 时重建）"""
+        if self._pool is None:
+            # 并发拉取各分片指标；Session 复用 HTTP keep-alive 连接
+            self._pool = ThreadPoolExecutor(max_workers=max(len(self.shard_addresses), 1))
+            self._session = requests.Session()
+
     def start(self, interval_seconds: int = 5):
         """启动监控"""
+        self._open_clients()
         self._running = True
         self._interval = interval_seconds
+        self.history = self._new_history(interval_seconds)
+
+        # 预热 CPU 采样：非阻塞的 cpu_percent 返回的是距上次调用的使用率
+        psutil.cpu_percent(interval=None)
 
         # 启动收集线程
         self._thread = threading.Thread(target=self._collect_loop, daemon=True)
@@ -103,6 +195,11 @@ class ClusterMonitor:
         self._running = False
         if hasattr(self, '_thread'):
             self._thread.join(timeout=5)
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._session.close()
+            self._pool = None
+            self._session = None
 
     def _collect_loop(self):
         """指标收集循环"""
@@ -112,67 +209,102 @@ class ClusterMonitor:
 
     def collect_metrics(self):
         """收集所有分片的指标"""
-        for shard_id, addr in enumerate(self.shard_addresses):
-            try:
-                # 尝试从分片获取指标
-                metrics = self._fetch_shard_metrics(addr)
+        self._open_clients()
 
-                # 更新本地指标
-                self.shards[shard_id].num_vectors = metrics.get('num_vectors', 0)
-                self.shards[shard_id].query_count = metrics.get('query_count', 0)
-                self.shards[shard_id].total_latency_ms = metrics.get('total_latency_ms', 0.0)
-                self.shards[shard_id].error_count = metrics.get('error_count', 0)
-                self.shards[shard_id].last_update = datetime.now()
+        # 系统指标每轮只采样一次（非阻塞），所有分片共用
+        cpu_percent = psutil.cpu_percent(interval=None)
+        memory_mb = psutil.virtual_memory().used / (1024 * 1024)
 
-                # 系统指标
-                self.shards[shard_id].cpu_percent = metrics.get('cpu_percent', 0.0)
-                self.shards[shard_id].memory_mb = metrics.get('memory_mb', 0.0)
+        # 同时向所有分片发起请求，总耗时取决于最慢的分片而非各分片之和
+        futures = {
+            self._pool.submit(self._fetch_shard_metrics, shard_id, addr, cpu_percent, memory_mb): shard_id
+            for shard_id, addr in enumerate(self.shard_addresses)
+        }
 
-            except Exception as e:
-                print(f"Error collecting metrics from shard {shard_id}: {e}")
+        pending = dict(futures)
+        try:
+            for future in as_completed(futures, timeout=FETCH_TIMEOUT_SECONDS):
+                shard_id = pending.pop(future)
+                self._apply_shard_metrics(shard_id, future)
+        except FuturesTimeoutError:
+            # 超时未返回的分片本轮记为失败，不阻塞整个收集周期
+            for future, shard_id in pending.items():
+                future.cancel()
+                print(f"Error collecting metrics from shard {shard_id}: "
+                      f"timed out after {FETCH_TIMEOUT_SECONDS}s")
 
         # 记录历史数据
         now = datetime.now()
+        self.history['cluster_queries'].append(
+            now, sum(s.query_count for s in self.shards.values()))
         for shard_id, shard in self.shards.items():
-            self.history[f'shard_{shard_id}_queries'].append((now, shard.query_count))
-            self.history[f'shard_{shard_id}_latency'].append((now, shard.avg_latency_ms))
-            self.history[f'shard_{shard_id}_errors'].append((now, shard.error_count))
-
-        # 清理旧数据（保留最近1小时）
-        cutoff = datetime.now() - timedelta(hours=1)
-        for key in self.history:
-            self.history[key] = [(t, v) for t, v in self.history[key] if t > cutoff]
-
-    def _fetch_shard_metrics(self, address: str) -> dict:
+            self.history[f'shard_{shard_id}_queries'].append(now, shard.query_count)
+            self.history[f'shard_{shard_id}_latency'].append(now, shard.avg_latency_ms)
+            self.history[f'shard_{shard_id}_errors'].append(now, shard.error_count)
+
+    def _apply_shard_metrics(self, shard_id: int, future):
+        """把已完成的拉取结果写入本地分片指标"""
+        try:
+            # 尝试从分片获取指标
+            metrics = future.result()
+
+            # 更新本地指标
+            self.shards[shard_id].num_vectors = metrics.get('num_vectors', 0)
+            self.shards[shard_id].query_count = metrics.get('query_count', 0)
+            self.shards[shard_id].total_latency_ms = metrics.get('total_latency_ms', 0.0)
+            self.shards[shard_id].error_count = metrics.get('error_count', 0)
+            self.shards[shard_id].last_update = datetime.now()
+            self.shards[shard_id].latency_samples.extend(metrics.get('latency_samples_ms', []))
+
+            # 系统指标
+            self.shards[shard_id].cpu_percent = metrics.get('cpu_percent', 0.0)
+            self.shards[shard_id].memory_mb = metrics.get('memory_mb', 0.0)
+
+        except Exception as e:
+            print(f"Error collecting metrics from shard {shard_id}: {e}")
+
+    def _fetch_shard_metrics(self, shard_id: int, address: str,
+                             cpu_percent: float, memory_mb: float) -> dict:
         """从分片获取指标（模拟）"""
         # 实际实现中，这里应该发送 HTTP 请求到分片的 metrics 端点
-        # 例如：response = requests.get(f"http://{address}/metrics")
+        # 例如：response = self._session.get(f"http://{address}/metrics", timeout=(0.5, 1.0))
 
-        # 模拟返回数据
+        # 模拟返回数据：单次延迟样本围绕该分片的平均延迟分布，
+        # 使 P99 与平均延迟相互一致
+        query_count = self.shards.get(shard_id, ShardMetrics(shard_id=0)).query_count + 10
+        total_latency_ms = 500.0
+        avg_latency_ms = total_latency_ms / query_count
         return {
             'num_vectors': 100000 + shard_id * 1000,
-            'query_count': self.shards.get(shard_id, ShardMetrics(shard_id=0)).query_count + 10,
-            'total_latency_ms': 500.0,
+            'query_count': query_count,
+            'total_latency_ms': total_latency_ms,
             'error_count': 0,
-            'cpu_percent': psutil.cpu_percent(interval=0.1),
-            'memory_mb': psutil.virtual_memory().used / (1024 * 1024)
+            'latency_samples_ms': self._rngs[shard_id].gamma(4.0, avg_latency_ms / 4.0, size=10),
+            'cpu_percent': cpu_percent,
+            'memory_mb': memory_mb
         }
 
     def get_cluster_metrics(self) -> ClusterMetrics:
         """计算集群级指标"""
-        total_queries = sum(s.query_count for s in self.shards.values())
-        total_errors = sum(s.error_count for s in self.shards.values())
-
-        # 计算 QPS（基于时间窗口）
-        elapsed = (datetime.now() - self._start_time).total_seconds()
-        qps = total_queries / elapsed if elapsed > 0 else 0
-
-        # 计算平均延迟
-        avg_latencies = [s.avg_latency_ms for s in self.shards.values() if s.query_count > 0]
-        avg_latency = sum(avg_latencies) / len(avg_latencies) if avg_latencies else 0
-
-        # 计算 P99 延迟（简化）
-        p99_latency = avg_latency * 1.5  # 简化计算
+        # 单次遍历累加各分片计数
+        total_queries = 0
+        total_errors = 0
+        total_latency_ms = 0.0
+        for s in self.shards.values():
+            total_queries += s.query_count
+            total_errors += s.error_count
+            total_latency_ms += s.total_latency_ms
+
+        # 计算 QPS（基于最近的时间窗口）
+        qps = self._windowed_qps(total_queries)
+
+        # 计算平均延迟：按查询数加权，而非对各分片均值再取平均
+        avg_latency = total_latency_ms / total_queries if total_queries else 0.0
+
+        # 计算 P99 延迟：合并各分片最近的延迟样本
+        samples = [s.latency_samples.values() for s in self.shards.values()]
+        samples = np.concatenate(samples) if samples else np.empty(0)
+        p99_latency = float(np.percentile(samples, 99)) if len(samples) else 0.0
 
         return ClusterMetrics(
             total_queries=total_queries,
@@ -182,6 +314,22 @@ class ClusterMonitor:
             p99_latency_ms=p99_latency
         )
 
+    def _windowed_qps(self, total_queries: int) -> float:
+        """根据最近 QPS_WINDOW_SECONDS 内的累计查询数增量计算 QPS"""
+        series = self.history.get('cluster_queries')
+        if series is not None and len(series) >= 2:
+            times, counts = series.arrays()
+            in_window = times >= times[-1] - np.timedelta64(QPS_WINDOW_SECONDS, 's')
+            # 窗口内最早的样本，至少与最新样本相隔一个采样点
+            first = min(int(np.argmax(in_window)), len(times) - 2)
+            elapsed = (times[-1] - times[first]) / np.timedelta64(1, 's')
+            if elapsed > 0:
+                return float(counts[-1] - counts[first]) / elapsed
+
+        # 样本不足时退化为自启动以来的平均值
+        elapsed = (datetime.now() - self._start_time).total_seconds()
+        return total_queries / elapsed if elapsed > 0 else 0.0
+
     def print_status(self):
         """打印集群状态"""
         cluster_metrics = self.get_cluster_metrics()
@@ -300,38 +448,29 @@ class Visualizer:
 
         fig, axes = plt.subplots(2, 1, figsize=(12, 8))
 
-        # 1. QPS 时间序列
-        for shard_id in self.monitor.shards.keys():
-            key = f'shard_{shard_id}_queries'
-            if key in self.monitor.history and self.monitor.history[key]:
-                times, values = zip(*self.monitor.history[key])
-                # 计算增量
-                increments = [values[i] - (values[i-1] if i > 0 else 0)
-                            for i in range(len(values))]
-                axes[0].plot(times, increments, label=f'Shard {shard_id}')
+        # 所有分片合并为一个 LineCollection，颜色按分片编号映射，两个子图共用
+        norm = Normalize(vmin=0, vmax=max(len(self.monitor.shards) - 1, 1))
+        cmap = plt.get_cmap('viridis')
 
+        # 1. QPS 时间序列（计算增量）
+        self._add_shard_lines(axes[0], 'queries', norm, cmap,
+                              transform=lambda values: np.diff(values, prepend=0))
         axes[0].set_xlabel('Time')
         axes[0].set_ylabel('Queries')
         axes[0].set_title('Query Rate Over Time')
-        axes[0].legend()
-        axes[0].xaxis.set_major_formatter(mdates.DateFormatter('%H:%M:%S'))
-        plt.setp(axes[0].xaxis.get_majorticklabels(), rotation=45)
 
         # 2. 延迟时间序列
-        for shard_id in self.monitor.shards.keys():
-            key = f'shard_{shard_id}_latency'
-            if key in self.monitor.history and self.monitor.history[key]:
-                times, values = zip(*self.monitor.history[key])
-                axes[1].plot(times, values, label=f'Shard {shard_id}')
-
+        self._add_shard_lines(axes[1], 'latency', norm, cmap)
         axes[1].set_xlabel('Time')
         axes[1].set_ylabel('Latency (ms)')
         axes[1].set_title('Latency Over Time')
-        axes[1].legend()
-        axes[1].xaxis.set_major_formatter(mdates.DateFormatter('%H:%M:%S'))
-        plt.setp(axes[1].xaxis.get_majorticklabels(), rotation=45)
 
-        plt.tight_layout()
+        for ax in axes:
+            ax.xaxis_date()
+            ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M:%S'))
+            plt.setp(ax.xaxis.get_majorticklabels(), rotation=45)
+
+        fig.colorbar(plt.cm.ScalarMappable(norm=norm, cmap=cmap), ax=axes, label='Shard ID')
 
         if save_path:
             plt.savefig(save_path, dpi=150, bbox_inches='tight')
@@ -339,6 +478,24 @@ class Visualizer:
         else:
             plt.show()
 
+    def _add_shard_lines(self, ax, metric: str, norm, cmap, transform=None):
+        """把所有分片的某项时间序列作为一个 LineCollection 绘制到 ax"""
+        segments, shard_ids = [], []
+        for shard_id in self.monitor.shards.keys():
+            key = f'shard_{shard_id}_{metric}'
+            if key in self.monitor.history and self.monitor.history[key]:
+                times, values = self.monitor.history[key].arrays()
+                if transform is not None:
+                    values = transform(values)
+                # 降采样：每条曲线最多保留 MAX_PLOT_POINTS 个点
+                stride = max(len(values) // MAX_PLOT_POINTS, 1)
+                segments.append(np.column_stack([mdates.date2num(times[::stride]), values[::stride]]))
+                shard_ids.append(shard_id)
+
+        if segments:
+            ax.add_collection(LineCollection(segments, colors=cmap(norm(shard_ids))))
+            ax.autoscale_view()
+
 
 def main():
     parser = argparse.ArgumentParser(description='Distributed Vector Search Cluster Monitor')
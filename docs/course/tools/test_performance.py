@@ -7,9 +7,12 @@ Comprehensive performance testing framework
     python test_performance.py
 """
 
+import os
 import time
 import numpy as np
 import psutil
+import matplotlib
+matplotlib.use('Agg')  # 只写 PNG，不依赖显示服务
 import matplotlib.pyplot as plt
 from dataclasses import dataclass
 from typing import List, Dict, Callable, Optional
@@ -24,6 +27,30 @@ except ImportError:
     USEARCH_AVAILABLE = False
     print("Warning: usearch not available. Install with: pip install usearch")
 
+# 尝试导入 simsimd（用于计算精确近邻，缺失时退回 NumPy）
+try:
+    import simsimd
+    SIMSIMD_AVAILABLE = True
+except ImportError:
+    SIMSIMD_AVAILABLE = False
+
+# 尝试导入 orjson（用于快速写出结果，缺失时退回标准库 json）
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# USearch 度量名对应的 simsimd 度量名（ip 在不同 simsimd 版本中符号不一致，用 NumPy 计算）
+SIMSIMD_METRICS = {'cos': 'cosine', 'l2sq': 'sqeuclidean'}
+
+
+# 索引存储精度对应的主机端数组类型（bf16 无对应格式，使用 f32）
+STORAGE_DTYPES = {'f32': np.float32, 'f16': np.float16, 'i8': np.int8}
+
+# 分块生成向量时每块的行数
+GENERATE_CHUNK = 1 << 16
+
 
 @dataclass
 class BenchmarkResult:
@@ -36,10 +63,12 @@ class BenchmarkResult:
     qps: float
     memory_mb: float
     recall: float = 0.0
+    category: str = 'build'  # build / config / quant / metric
 
     def to_dict(self) -> dict:
         return {
             'name': self.name,
+            'category': self.category,
             'n_vectors': self.n_vectors,
             'dimensions': self.dimensions,
             'build_time': self.build_time,
@@ -50,20 +79,134 @@ class BenchmarkResult:
         }
 
 
+# 结果表的列式布局，供绘图和汇总按列批量筛选
+RESULT_DTYPE = np.dtype([
+    ('name', 'U64'),
+    ('category', 'U16'),
+    ('label', 'U48'),
+    ('n_vectors', np.int64),
+    ('dimensions', np.int64),
+    ('build_time', np.float64),
+    ('search_latency', np.float64),
+    ('qps', np.float64),
+    ('memory_mb', np.float64),
+    ('recall', np.float64),
+])
+
+
 class PerformanceTester:
     """性能测试器"""
 
-    def __init__(self):
+    def __init__(self, seed: int = 0):
         self.results: List[BenchmarkResult] = []
+        # 单个带种子的生成器贯穿所有测试，保证多次运行的输入可复现
+        self.rng = np.random.default_rng(seed)
+        # 测试数据缓存：{(dimensions, normalize): (vectors, ids, queries)}，按需取前缀
+        self._datasets: Dict[tuple, tuple] = {}
 
-    def generate_vectors(self, n: int, dimensions: int, dtype=np.float32) -> np.ndarray:
-        """生成随机向量"""
-        return np.random.rand(n, dimensions).astype(dtype)
+    def generate_vectors(
+        self,
+        n: int,
+        dimensions: int,
+        normalize: bool = False
+    ) -> np.ndarray:
+        """生成随机 f32 向量
+
+        直接以 f32 按块采样到结果数组中（需要时逐块原地 L2 归一化），
+        避免整块 float64 临时数组造成的峰值内存。
+        转换为索引存储精度由 to_storage 负责。
+        """
+        out = np.empty((n, dimensions), dtype=np.float32)
+
+        for start in range(0, n, GENERATE_CHUNK):
+            block = out[start:start + GENERATE_CHUNK]
+            self.rng.random(out=block, dtype=np.float32)
+            if normalize:
+                self.normalize_vectors(block)
+
+        return out
+
+    @staticmethod
+    def quantize_i8(vectors: np.ndarray) -> np.ndarray:
+        """逐行对称缩放到 [-127, 127]，不改变向量方向"""
+        scale = np.abs(vectors).max(axis=1, keepdims=True) / 127
+        scale[scale == 0] = 1
+        return np.clip(np.round(vectors / scale), -127, 127).astype(np.int8)
+
+    def to_storage(self, vectors: np.ndarray, dtype: str) -> np.ndarray:
+        """把 f32 向量转换为索引的存储精度（bf16 以 f32 传入）
+
+        返回 C 连续且类型与索引一致的数组，避免切片或类型不符时
+        USearch 在 C++ 层内部再隐式复制一次；已符合要求的输入不会复制
+        """
+        if dtype == 'i8':
+            vectors = self.quantize_i8(vectors)
+        return np.ascontiguousarray(vectors, dtype=STORAGE_DTYPES.get(dtype, np.float32))
+
+    def dataset(self, n: int, dimensions: int, normalize: bool = False, n_queries: int = 1000) -> tuple:
+        """返回缓存的 f32 测试数据 (vectors, ids, queries)
+
+        同一维度和归一化方式只缓存一份数据，较小规模取其前缀切片（零拷贝），
+        各测试共用相同输入，结果之间可以直接比较。请求的规模超过缓存时
+        先释放旧数据再重新生成，同一组参数始终只驻留一份
+        """
+        key = (dimensions, normalize)
+        cached = self._datasets.get(key)
+        if cached is None or len(cached[0]) < n or len(cached[2]) < n_queries:
+            self._datasets.pop(key, None)
+            del cached
+            self._datasets[key] = (
+                self.generate_vectors(n, dimensions, normalize=normalize),
+                np.arange(n, dtype=np.uint32),
+                self.generate_vectors(n_queries, dimensions, normalize=normalize),
+            )
+        vectors, ids, queries = self._datasets[key]
+        return vectors[:n], ids[:n], queries[:n_queries]
 
     def normalize_vectors(self, vectors: np.ndarray) -> np.ndarray:
-        """L2 归一化"""
-        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
-        return vectors / norms
+        """原地 L2 归一化
+
+        einsum 一次遍历求平方和，再原地乘以范数的倒数，不生成临时数组
+        """
+        inv_norms = np.einsum('ij,ij->i', vectors, vectors)
+        np.sqrt(inv_norms, out=inv_norms)
+        np.reciprocal(inv_norms, out=inv_norms)
+        vectors *= inv_norms[:, None]
+        return vectors
+
+    @staticmethod
+    def process_memory_mb(process: psutil.Process) -> float:
+        """进程独占内存 (USS, MB)；平台不支持时退回 RSS"""
+        try:
+            return process.memory_full_info().uss / 1024 / 1024
+        except (psutil.AccessDenied, AttributeError):
+            return process.memory_info().rss / 1024 / 1024
+
+    def exact_neighbors(
+        self,
+        queries: np.ndarray,
+        vectors: np.ndarray,
+        metric: str = 'cos',
+        k: int = 10
+    ) -> np.ndarray:
+        """暴力计算每个查询的精确 k 近邻，返回 (n_queries, k) 的行号"""
+        if SIMSIMD_AVAILABLE and metric in SIMSIMD_METRICS:
+            distances = np.asarray(simsimd.cdist(queries, vectors, metric=SIMSIMD_METRICS[metric]))
+        else:
+            products = queries.astype(np.float32) @ vectors.astype(np.float32).T
+            if metric == 'l2sq':
+                distances = (np.einsum('ij,ij->i', vectors, vectors)[None, :]
+                             - 2 * products
+                             + np.einsum('ij,ij->i', queries, queries)[:, None])
+            elif metric == 'cos':
+                norms_q = np.sqrt(np.einsum('ij,ij->i', queries, queries))
+                norms_v = np.sqrt(np.einsum('ij,ij->i', vectors, vectors))
+                distances = 1 - products / (norms_q[:, None] * norms_v[None, :])
+            else:
+                distances = 1 - products
+
+        # 召回率按集合计算，前 k 个内部无需有序
+        return np.argpartition(distances, k - 1, axis=1)[:, :k]
 
     def test_build_performance(
         self,
@@ -72,9 +215,17 @@ class PerformanceTester:
         metric: str = 'cos',
         dtype: str = 'f32',
         connectivity: int = 16,
-        expansion: int = 64
+        expansion: int = 64,
+        vectors: Optional[np.ndarray] = None,
+        ids: Optional[np.ndarray] = None,
+        queries: Optional[np.ndarray] = None,
+        recall_k: int = 0
     ) -> BenchmarkResult:
-        """测试构建性能"""
+        """测试构建性能
+
+        未传入 vectors/ids/queries 时使用缓存的同规模数据。
+        recall_k > 0 时在同一个索引上测量 Recall@k，召回率与被测配置对应
+        """
         if not USEARCH_AVAILABLE:
             raise RuntimeError("usearch not available")
 
@@ -82,17 +233,22 @@ class PerformanceTester:
         print(f"测试: 构建性能 ({n_vectors:,} 向量, {dimensions} 维)")
         print(f"配置: metric={metric}, dtype={dtype}, M={connectivity}, ef={expansion}")
 
-        # 生成数据
-        print("生成数据...")
-        vectors = self.generate_vectors(n_vectors, dimensions)
-        ids = np.arange(n_vectors, dtype=np.uint32)
-
-        if metric == 'cos':
-            vectors = self.normalize_vectors(vectors)
+        # 准备数据
+        if vectors is None or ids is None or queries is None:
+            print("生成数据...")
+            cached_vectors, cached_ids, cached_queries = self.dataset(
+                n_vectors, dimensions, normalize=metric == 'cos')
+            vectors = cached_vectors if vectors is None else vectors
+            ids = cached_ids if ids is None else ids
+            queries = cached_queries if queries is None else queries
+        # 保留 f32 原始数据，用于计算精确近邻
+        exact_vectors, exact_queries = vectors, queries
+        vectors = self.to_storage(vectors, dtype)
+        queries = self.to_storage(queries, dtype)
 
         # 记录初始内存
         process = psutil.Process()
-        initial_memory = process.memory_info().rss / 1024 / 1024  # MB
+        initial_memory = self.process_memory_mb(process)
 
         # 创建索引
         print("创建索引...")
@@ -101,45 +257,54 @@ class PerformanceTester:
             metric=metric,
             dtype=dtype,
             connectivity=connectivity,
-            expansion=expansion
+            expansion_add=expansion,
+            expansion_search=expansion
         )
 
         # 构建索引
         print("添加向量...")
-        start = time.time()
-        index.add(ids, vectors)
-        build_time = time.time() - start
+        # 批量 add 会按总数一次性预留容量，再多线程并行插入
+        assert vectors.flags['C_CONTIGUOUS'] and queries.flags['C_CONTIGUOUS']
+        start = time.perf_counter_ns()
+        index.add(ids, vectors, threads=os.cpu_count())
+        build_time = (time.perf_counter_ns() - start) / 1e9
 
         print(f"✓ 构建完成: {build_time:.2f} 秒")
         print(f"  速度: {n_vectors / build_time:,.0f} 向量/秒")
 
         # 测试搜索性能
         print("\n测试搜索性能...")
-        n_queries = 1000
-        queries = self.generate_vectors(n_queries, dimensions)
+        n_queries = len(queries)
 
-        if metric == 'cos':
-            queries = self.normalize_vectors(queries)
+        # 吞吐量：整批提交，由 USearch 在 C++ 内部多线程并行处理
+        start = time.perf_counter_ns()
+        index.search(queries, 10, threads=os.cpu_count())
+        total_ns = time.perf_counter_ns() - start
+        qps = n_queries / (total_ns / 1e9)
 
-        start = time.time()
-        for i in range(n_queries):
-            index.search(queries[i], k=10)
-        total_time = time.time() - start
-
-        search_latency = (total_time / n_queries) * 1000  # ms
-        qps = n_queries / total_time
+        # 延迟：单独逐条查询一小部分，反映单次请求的响应时间
+        n_latency_queries = min(100, n_queries)
+        start = time.perf_counter_ns()
+        for query in queries[:n_latency_queries]:
+            index.search(query, 10)
+        search_latency = (time.perf_counter_ns() - start) / n_latency_queries / 1e6  # ms
 
         print(f"✓ 搜索性能:")
         print(f"  平均延迟: {search_latency:.2f} ms")
         print(f"  QPS: {qps:,.0f}")
 
         # 内存使用
-        final_memory = process.memory_info().rss / 1024 / 1024  # MB
-        memory_mb = final_memory - initial_memory
+        # 以索引自身统计的字节数为准；进程内存增量仅作参考
+        memory_mb = index.memory_usage / 1024 / 1024
+        process_delta_mb = self.process_memory_mb(process) - initial_memory
 
-        print(f"  内存使用: {memory_mb:.1f} MB")
+        print(f"  内存使用: {memory_mb:.1f} MB (进程增量 {process_delta_mb:.1f} MB)")
         print(f"  每向量: {memory_mb * 1024 / n_vectors:.2f} KB")
 
+        recall = 0.0
+        if recall_k > 0:
+            recall = self._recall_at_k(index, exact_vectors, exact_queries[:100], metric, recall_k)
+
         return BenchmarkResult(
             name=f"build_{n_vectors}_{dimensions}",
             n_vectors=n_vectors,
@@ -147,7 +312,8 @@ class PerformanceTester:
             build_time=build_time,
             search_latency=search_latency,
             qps=qps,
-            memory_mb=memory_mb
+            memory_mb=memory_mb,
+            recall=recall
         )
 
     def test_recall(
@@ -155,39 +321,39 @@ class PerformanceTester:
         n_vectors: int,
         dimensions: int,
         metric: str = 'cos',
-        k: int = 10
+        k: int = 10,
+        n_queries: int = 100
     ) -> float:
-        """测试召回率"""
+        """测试召回率（使用缓存的同规模数据）"""
         if not USEARCH_AVAILABLE:
             raise RuntimeError("usearch not available")
 
         print(f"\n{'='*60}")
         print(f"测试: 召回率 ({n_vectors:,} 向量, {dimensions} 维)")
 
-        # 生成数据
-        vectors = self.generate_vectors(n_vectors, dimensions)
-        ids = np.arange(n_vectors, dtype=np.uint32)
-
-        if metric == 'cos':
-            vectors = self.normalize_vectors(vectors)
+        # 准备数据
+        vectors, ids, queries = self.dataset(n_vectors, dimensions, normalize=metric == 'cos')
+        queries = queries[:n_queries]
 
         # 创建索引
         index = Index(ndim=dimensions, metric=metric)
-        index.add(ids, vectors)
+        index.add(ids, vectors, threads=os.cpu_count())
 
-        # 测试召回率
-        n_queries = 100
-        queries = vectors[:n_queries]  # 使用前100个作为查询
+        return self._recall_at_k(index, vectors, queries, metric, k)
 
-        correct = 0
-        for i in range(n_queries):
-            results = index.search(queries[i], k=k)
-            # 第一个结果应该是自己（距离≈0）
-            if len(results) > 0 and results[0].key == ids[i]:
-                correct += 1
+    def _recall_at_k(self, index, vectors: np.ndarray, queries: np.ndarray,
+                     metric: str, k: int) -> float:
+        """与暴力搜索得到的精确 k 近邻比较（Recall@k）
 
-        recall = correct / n_queries
-        print(f"✓ 召回率: {recall:.2%}")
+        要求索引中向量的键等于其在 vectors 中的行号
+        """
+        ground_truth = self.exact_neighbors(queries, vectors, metric, k)
+
+        matches = index.search(queries, k, exact=False)
+        retrieved = matches.keys.astype(np.int64)
+        hits = (retrieved[:, :, None] == ground_truth[:, None, :]).any(axis=2).sum(axis=1)
+        recall = float(hits.mean() / k)
+        print(f"✓ 召回率@{k}: {recall:.2%}")
 
         return recall
 
@@ -199,6 +365,16 @@ class PerformanceTester:
         dimensions = 128
         sizes = [1000, 10000, 100000, 1000000]
 
+        # 只生成最大规模的数据集一次，各规模取其前缀切片（零拷贝视图）；
+        # 生成失败（如内存不足）时跳过最大规模，退回到次大规模
+        while sizes:
+            try:
+                vectors, ids, queries = self.dataset(sizes[-1], dimensions, normalize=True)
+                break
+            except Exception as e:
+                print(f"✗ 失败 ({sizes[-1]:,} 向量): {e}")
+                sizes = sizes[:-1]
+
         for size in sizes:
             try:
                 result = self.test_build_performance(
@@ -206,7 +382,10 @@ class PerformanceTester:
                     dimensions=dimensions,
                     metric='cos',
                     connectivity=16,
-                    expansion=64
+                    expansion=64,
+                    vectors=vectors[:size],
+                    ids=ids[:size],
+                    queries=queries
                 )
                 self.results.append(result)
             except Exception as e:
@@ -234,13 +413,11 @@ class PerformanceTester:
                     dimensions=dimensions,
                     metric='cos',
                     connectivity=config['connectivity'],
-                    expansion=config['expansion']
+                    expansion=config['expansion'],
+                    recall_k=10
                 )
                 result.name = f"config_{config['name']}"
-
-                # 测试召回率
-                result.recall = self.test_recall(n_vectors, dimensions)
-
+                result.category = 'config'
                 self.results.append(result)
             except Exception as e:
                 print(f"✗ 失败: {e}")
@@ -265,6 +442,7 @@ class PerformanceTester:
                     dtype=dtype
                 )
                 result.name = f"quant_{dtype}"
+                result.category = 'quant'
                 self.results.append(result)
             except Exception as e:
                 print(f"✗ 失败: {e}")
@@ -288,75 +466,72 @@ class PerformanceTester:
                     metric=metric
                 )
                 result.name = f"metric_{metric}"
+                result.category = 'metric'
                 self.results.append(result)
             except Exception as e:
                 print(f"✗ 失败: {e}")
 
+    def results_table(self) -> np.ndarray:
+        """把结果列表转换为 NumPy 结构化数组（每个字段一列）"""
+        return np.array([
+            (r.name, r.category, r.name.removeprefix(f'{r.category}_'),
+             r.n_vectors, r.dimensions, r.build_time, r.search_latency,
+             r.qps, r.memory_mb, r.recall)
+            for r in self.results
+        ], dtype=RESULT_DTYPE)
+
     def plot_results(self, save_path: str = "performance_plots.png"):
         """绘制性能图表"""
         if not self.results:
             print("没有结果可绘制")
             return
 
+        table = self.results_table()
         fig, axes = plt.subplots(2, 2, figsize=(12, 10))
 
         # 1. 构建时间 vs 向量数量
-        if len(self.results) > 0:
-            scaling_results = [r for r in self.results if 'build_' in r.name]
-            if scaling_results:
-                axes[0, 0].plot(
-                    [r.n_vectors for r in scaling_results],
-                    [r.build_time for r in scaling_results],
-                    marker='o'
-                )
-                axes[0, 0].set_xscale('log')
-                axes[0, 0].set_xlabel('向量数量')
-                axes[0, 0].set_ylabel('构建时间 (秒)')
-                axes[0, 0].set_title('构建时间 vs 向量数量')
-                axes[0, 0].grid(True)
+        scaling_results = table[table['category'] == 'build']
+        if len(scaling_results):
+            axes[0, 0].plot(scaling_results['n_vectors'], scaling_results['build_time'], marker='o')
+            axes[0, 0].set_xscale('log')
+            axes[0, 0].set_xlabel('向量数量')
+            axes[0, 0].set_ylabel('构建时间 (秒)')
+            axes[0, 0].set_title('构建时间 vs 向量数量')
+            axes[0, 0].grid(True)
 
         # 2. QPS vs 配置
-        config_results = [r for r in self.results if 'config_' in r.name]
-        if config_results:
-            configs = [r.name.replace('config_', '') for r in config_results]
-            qps_values = [r.qps for r in config_results]
-
-            axes[0, 1].bar(configs, qps_values)
+        config_results = table[table['category'] == 'config']
+        if len(config_results):
+            axes[0, 1].bar(config_results['label'], config_results['qps'])
             axes[0, 1].set_ylabel('QPS')
             axes[0, 1].set_title('QPS vs 配置')
             axes[0, 1].grid(True, axis='y')
 
         # 3. 内存使用
-        if len(self.results) > 0:
-            quant_results = [r for r in self.results if 'quant_' in r.name]
-            if quant_results:
-                dtypes = [r.name.replace('quant_', '') for r in quant_results]
-                memory = [r.memory_mb for r in quant_results]
-
-                axes[1, 0].bar(dtypes, memory)
-                axes[1, 0].set_ylabel('内存 (MB)')
-                axes[1, 0].set_title('内存使用 vs 量化类型')
-                axes[1, 0].grid(True, axis='y')
+        quant_results = table[table['category'] == 'quant']
+        if len(quant_results):
+            axes[1, 0].bar(quant_results['label'], quant_results['memory_mb'])
+            axes[1, 0].set_ylabel('内存 (MB)')
+            axes[1, 0].set_title('内存使用 vs 量化类型')
+            axes[1, 0].grid(True, axis='y')
 
         # 4. 延迟 vs 召回率
-        config_results = [r for r in self.results if 'config_' in r.name and r.recall > 0]
-        if config_results:
-            recalls = [r.recall for r in config_results]
-            latencies = [r.search_latency for r in config_results]
+        config_results = config_results[config_results['recall'] > 0]
+        if len(config_results):
+            recalls = config_results['recall']
+            latencies = config_results['search_latency']
 
             axes[1, 1].scatter(recalls, latencies, s=100)
-            for i, r in enumerate(config_results):
-                axes[1, 1].annotate(
-                    r.name.replace('config_', ''),
-                    (recalls[i], latencies[i])
-                )
+            for label, recall, latency in zip(config_results['label'], recalls, latencies):
+                axes[1, 1].annotate(label, (recall, latency))
             axes[1, 1].set_xlabel('召回率')
             axes[1, 1].set_ylabel('搜索延迟 (ms)')
             axes[1, 1].set_title('延迟 vs 召回率')
             axes[1, 1].grid(True)
 
         plt.tight_layout()
-        plt.savefig(save_path, dpi=150, bbox_inches='tight')
+        fig.savefig(save_path, dpi=150, bbox_inches='tight')
+        plt.close(fig)
         print(f"\n✓ 图表已保存: {save_path}")
 
     def save_results(self, path: str = "performance_results.json"):
@@ -366,8 +541,13 @@ class PerformanceTester:
             'results': [r.to_dict() for r in self.results]
         }
 
-        with open(path, 'w') as f:
-            json.dump(data, f, indent=2)
+        if ORJSON_AVAILABLE:
+            # orjson 在 C 扩展中直接序列化（含 NumPy 数组/标量），输出为 bytes
+            Path(path).write_bytes(orjson.dumps(
+                data, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+        else:
+            with open(path, 'w') as f:
+                json.dump(data, f, indent=2)
 
         print(f"✓ 结果已保存: {path}")
 
@@ -390,9 +570,10 @@ class PerformanceTester:
                   f"{r.qps:<10,.0f} {r.memory_mb:<10.1f}")
 
         # 统计
-        print(f"\n总测试数: {len(self.results)}")
-        print(f"总向量数: {sum(r.n_vectors for r in self.results):,}")
-        print(f"总测试时间: {sum(r.build_time for r in self.results):.1f} 秒")
+        table = self.results_table()
+        print(f"\n总测试数: {len(table)}")
+        print(f"总向量数: {table['n_vectors'].sum():,}")
+        print(f"总测试时间: {table['build_time'].sum():.1f} 秒")
 
 
 def main():
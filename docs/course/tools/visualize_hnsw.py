@@ -4,13 +4,39 @@ USearch HNSW 可视化工具
 用于可视化 HNSW 图的结构、层级分布和搜索过程
 """
 
+import os
 import numpy as np
+import matplotlib
+
+# 设置 HEADLESS 环境变量时只写 PNG：使用 Agg 后端，不初始化 GUI，也不弹出窗口
+HEADLESS = bool(os.environ.get('HEADLESS'))
+if HEADLESS:
+    matplotlib.use('Agg')
+
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
+from matplotlib.collections import LineCollection
 from matplotlib.patches import FancyArrowPatch
-import networkx as nx
 from typing import List, Tuple, Dict
-import random
+from collections import deque
+
+
+# 设置 PUB 环境变量时按出版分辨率输出，日常迭代用低分辨率以减少 PNG 编码时间
+DPI = 300 if os.environ.get('PUB') else 100
+
+# 节点数超过该值时不再逐个绘制编号标签（每个标签都是一个 Text 对象）
+MAX_NODE_LABELS = 200
+
+# 模块共用的随机数生成器，固定种子使每次生成的演示图一致
+_rng = np.random.default_rng(42)
+
+
+def _show_or_close(fig):
+    """交互模式下显示图表；无界面模式下直接释放图表"""
+    if HEADLESS:
+        plt.close(fig)
+    else:
+        plt.show()
 
 
 class HNSWVisualizer:
@@ -20,14 +46,19 @@ class HNSWVisualizer:
         self.dimensions = dimensions
         self.nodes = {}  # {node_id: {level: position}}
         self.edges = {}  # {level: [(src, dst), ...]}
+        # 由 nodes/edges 派生的索引，每次绘图前由 _ensure_index 重新构建
+        self._rows = {}  # {node_id: 行号}
+        self._positions = np.empty((0, 2))  # 按行号排列的节点坐标
+        self._edge_arrays = {}  # {level: (src_rows, dst_rows)}，列式存储的边
+        self._adj = {}  # {level: {src: dsts}}，按源节点索引的邻接表（节点编号）
 
     def generate_random_graph(self, n_nodes=50, n_levels=3, avg_connections=4):
         """生成随机 HNSW 图用于演示"""
         # 生成节点位置（2D）
         for node_id in range(n_nodes):
             self.nodes[node_id] = {
-                'position': np.random.rand(2) * 10,
-                'level': random.randint(0, n_levels)
+                'position': _rng.random(2) * 10,
+                'level': int(_rng.integers(0, n_levels, endpoint=True))
             }
 
         # 为每一层生成边
@@ -40,46 +71,84 @@ class HNSWVisualizer:
 
             # 随机连接
             for nid in nodes_in_level:
-                n_connections = random.randint(1, avg_connections)
+                n_connections = int(_rng.integers(1, avg_connections, endpoint=True))
                 candidates = [n for n in nodes_in_level if n != nid]
                 if candidates:
-                    neighbors = random.sample(candidates,
-                                            min(n_connections, len(candidates)))
+                    neighbors = _rng.choice(candidates, min(n_connections, len(candidates)),
+                                            replace=False).tolist()
                     for neighbor in neighbors:
                         self.edges[level].append((nid, neighbor))
 
+    def _ensure_index(self):
+        """根据当前的 nodes/edges 构建派生索引
+
+        每次绘图都重建（O(V+E)，与绘图本身同阶），节点移动或边改动后
+        不会画出旧数据。节点编号不要求是 0..n-1：坐标按行号排成 (n, 2)
+        数组，节点编号通过 _rows 映射到行号
+        """
+        node_ids = list(self.nodes)
+        self._rows = {nid: row for row, nid in enumerate(node_ids)}
+        self._positions = np.array([self.nodes[nid]['position'] for nid in node_ids],
+                                   dtype=float).reshape(-1, 2)
+        self._edge_arrays = {}
+        self._adj = {}
+        for level in self.edges:
+            self._index_edges(level, node_ids)
+
+    def _index_edges(self, level, node_ids):
+        """为某层建立列式边表和按源节点的邻接索引，查邻居只需 O(度数)"""
+        # 忽略端点不在 nodes 中的边
+        edges = [(self._rows[src], self._rows[dst]) for src, dst in self.edges[level]
+                 if src in self._rows and dst in self._rows]
+        srcs = np.fromiter((src for src, _ in edges), dtype=np.int64, count=len(edges))
+        dsts = np.fromiter((dst for _, dst in edges), dtype=np.int64, count=len(edges))
+        self._edge_arrays[level] = (srcs, dsts)
+
+        order = np.argsort(srcs, kind='stable')
+        unique_srcs, starts = np.unique(srcs[order], return_index=True)
+        self._adj[level] = {node_ids[src]: [node_ids[dst] for dst in group]
+                            for src, group in zip(unique_srcs.tolist(),
+                                                  np.split(dsts[order], starts[1:]))}
+
+    def _rows_of(self, node_ids):
+        """节点编号列表 -> 行号数组"""
+        return np.fromiter((self._rows[nid] for nid in node_ids), dtype=np.int64, count=len(node_ids))
+
+    def _level_segments(self, level, rows_in_level):
+        """返回某层两端都在该层内的边，形状为 (n_edges, 2, 2) 的线段数组"""
+        srcs, dsts = self._edge_arrays.get(level, (np.empty(0, dtype=np.int64),) * 2)
+        mask = np.isin(srcs, rows_in_level) & np.isin(dsts, rows_in_level)
+        return np.stack([self._positions[srcs[mask]], self._positions[dsts[mask]]], axis=1)
+
     def visualize_level(self, level=0, save_path=None):
         """可视化特定层"""
+        self._ensure_index()
         fig, ax = plt.subplots(figsize=(12, 10))
 
-        # 收集该层的节点和边
+        # 收集该层的节点
         nodes_in_level = [nid for nid in self.nodes
                          if self.nodes[nid]['level'] >= level]
-        edges_in_level = self.edges.get(level, [])
-
-        # 绘制边
-        for src, dst in edges_in_level:
-            if src in nodes_in_level and dst in nodes_in_level:
-                pos1 = self.nodes[src]['position']
-                pos2 = self.nodes[dst]['position']
-                ax.plot([pos1[0], pos2[0]], [pos1[1], pos2[1]],
-                       'b-', alpha=0.3, linewidth=1)
-
-        # 绘制节点
-        for nid in nodes_in_level:
-            pos = self.nodes[nid]['position']
-            node_level = self.nodes[nid]['level']
-
-            # 不同层级使用不同颜色和大小
-            colors = ['lightgreen', 'yellow', 'orange', 'red']
-            color = colors[min(node_level, len(colors)-1)]
-            size = 100 + node_level * 50
-
-            ax.scatter(pos[0], pos[1], s=size, c=color,
-                      edgecolors='black', linewidths=1, zorder=10)
-            ax.text(pos[0], pos[1], str(nid),
-                   ha='center', va='center', fontsize=8,
-                   fontweight='bold', zorder=11)
+        rows_in_level = self._rows_of(nodes_in_level)
+
+        # 绘制边（所有边合并为一个 LineCollection）
+        ax.add_collection(LineCollection(self._level_segments(level, rows_in_level),
+                                         colors='b', alpha=0.3, linewidths=1))
+
+        # 绘制节点（一次 scatter 调用）
+        positions = self._positions[rows_in_level]
+        node_levels = np.array([self.nodes[nid]['level'] for nid in nodes_in_level], dtype=int)
+
+        # 不同层级使用不同颜色和大小
+        colors = np.array(['lightgreen', 'yellow', 'orange', 'red'])
+        ax.scatter(positions[:, 0], positions[:, 1], s=100 + node_levels * 50,
+                   c=colors[np.minimum(node_levels, len(colors) - 1)],
+                   edgecolors='black', linewidths=1, zorder=10)
+
+        if len(nodes_in_level) <= MAX_NODE_LABELS:
+            for nid, pos in zip(nodes_in_level, positions):
+                ax.text(pos[0], pos[1], str(nid),
+                       ha='center', va='center', fontsize=8,
+                       fontweight='bold', zorder=11)
 
         ax.set_title(f'HNSW Layer {level} Visualization', fontsize=16)
         ax.set_xlabel('X', fontsize=12)
@@ -98,89 +167,79 @@ class HNSWVisualizer:
         plt.tight_layout()
 
         if save_path:
-            plt.savefig(save_path, dpi=300, bbox_inches='tight')
+            plt.savefig(save_path, dpi=DPI, bbox_inches='tight')
             print(f"图表已保存到: {save_path}")
 
-        plt.show()
+        _show_or_close(fig)
 
     def visualize_search_process(self, start_node=0, target_node=25,
                                level=0, save_path=None):
         """可视化搜索过程"""
+        self._ensure_index()
         fig, ax = plt.subplots(figsize=(14, 10))
 
-        # 收集该层的节点和边
+        # 收集该层的节点
         nodes_in_level = [nid for nid in self.nodes
                          if self.nodes[nid]['level'] >= level]
-        edges_in_level = self.edges.get(level, [])
-
-        # 绘制所有边（灰色）
-        for src, dst in edges_in_level:
-            if src in nodes_in_level and dst in nodes_in_level:
-                pos1 = self.nodes[src]['position']
-                pos2 = self.nodes[dst]['position']
-                ax.plot([pos1[0], pos2[0]], [pos1[1], pos2[1]],
-                       'gray', alpha=0.2, linewidth=1)
-
-        # 模拟搜索路径（简化版：BFS）
-        visited = {start_node}
-        queue = [start_node]
-        search_path = [start_node]
-        found = False
+        rows_in_level = self._rows_of(nodes_in_level)
+
+        # 绘制所有边（灰色，合并为一个 LineCollection）
+        ax.add_collection(LineCollection(self._level_segments(level, rows_in_level),
+                                         colors='gray', alpha=0.2, linewidths=1))
 
-        while queue and not found:
-            current = queue.pop(0)
-            search_path.append(current)
+        # 模拟搜索路径（简化版：沿有向边的最短路径，BFS 查邻接索引）
+        adjacency = self._adj.get(level, {})
+        in_level = set(nodes_in_level)
+        parents = {start_node: None}
+        queue = deque([start_node])
 
+        while queue:
+            current = queue.popleft()
             if current == target_node:
-                found = True
                 break
 
-            # 找邻居
-            for src, dst in edges_in_level:
-                if src == current and dst in nodes_in_level and dst not in visited:
-                    visited.add(dst)
+            for dst in adjacency.get(current, ()):
+                if dst in in_level and dst not in parents:
+                    parents[dst] = current
                     queue.append(dst)
 
-        # 绘制搜索路径
-        for i in range(len(search_path) - 1):
-            src = search_path[i]
-            dst = search_path[i + 1]
-            pos1 = self.nodes[src]['position']
-            pos2 = self.nodes[dst]['position']
-
-            # 根据在路径中的位置设置颜色
-            progress = i / len(search_path)
-            color = plt.cm.RdYlGn(progress)
-            ax.plot([pos1[0], pos2[0]], [pos1[1], pos2[1]],
-                   color=color, linewidth=3, alpha=0.8)
-
-        # 绘制节点
-        for nid in nodes_in_level:
-            pos = self.nodes[nid]['position']
-
-            if nid == start_node:
-                color = 'green'
-                size = 300
-                label = 'Start'
-            elif nid == target_node:
-                color = 'red'
-                size = 300
-                label = 'Target'
-            elif nid in visited:
-                color = 'lightblue'
-                size = 150
-                label = str(nid)
-            else:
-                color = 'lightgray'
-                size = 100
-                label = ''
-
-            ax.scatter(pos[0], pos[1], s=size, c=color,
-                      edgecolors='black', linewidths=2, zorder=10)
-            if label:
-                ax.text(pos[0], pos[1], label,
-                       ha='center', va='center', fontsize=10,
-                       fontweight='bold', zorder=11)
+        # 回溯路径；目标不可达时只显示起点
+        search_path = [start_node]
+        if target_node in parents:
+            search_path = [target_node]
+            while parents[search_path[-1]] is not None:
+                search_path.append(parents[search_path[-1]])
+            search_path.reverse()
+        visited = set(search_path)
+
+        # 绘制搜索路径，根据在路径中的位置设置颜色
+        path_positions = self._positions[self._rows_of(search_path)]
+        path_segments = np.stack([path_positions[:-1], path_positions[1:]], axis=1)
+        progress = np.arange(len(path_segments)) / len(search_path)
+        ax.add_collection(LineCollection(path_segments, colors=plt.cm.RdYlGn(progress),
+                                         linewidths=3, alpha=0.8))
+
+        # 绘制节点（一次 scatter 调用）
+        node_ids = np.asarray(nodes_in_level)
+        positions = self._positions[rows_in_level]
+        is_start = node_ids == start_node
+        is_target = node_ids == target_node
+        is_visited = np.isin(node_ids, list(visited))
+        conditions = [is_start, is_target, is_visited]
+
+        ax.scatter(positions[:, 0], positions[:, 1],
+                   s=np.select(conditions, [300, 300, 150], default=100),
+                   c=np.select(conditions, ['green', 'red', 'lightblue'], default='lightgray'),
+                   edgecolors='black', linewidths=2, zorder=10)
+
+        # 节点过多时只标注起点和终点
+        if len(node_ids) > MAX_NODE_LABELS:
+            conditions = conditions[:2]
+        labels = np.select(conditions, ['Start', 'Target', node_ids.astype(str)][:len(conditions)], default='')
+        for i in np.flatnonzero(labels != ''):
+            ax.text(positions[i, 0], positions[i, 1], labels[i],
+                   ha='center', va='center', fontsize=10,
+                   fontweight='bold', zorder=11)
 
         ax.set_title(f'HNSW Search Process (Level {level})', fontsize=16)
         ax.set_xlabel('X', fontsize=12)
@@ -190,25 +249,20 @@ class HNSWVisualizer:
         plt.tight_layout()
 
         if save_path:
-            plt.savefig(save_path, dpi=300, bbox_inches='tight')
+            plt.savefig(save_path, dpi=DPI, bbox_inches='tight')
             print(f"图表已保存到: {save_path}")
 
-        plt.show()
+        _show_or_close(fig)
 
 
 def visualize_level_distribution(max_level=10, ml=0.5, n_nodes=10000):
     """可视化层级分布"""
-    # 生成层级
-    levels = []
-    for _ in range(n_nodes):
-        u = random.random()
-        level = int(-np.log(u) / np.log(1/ml))
-        levels.append(level)
+    # 生成层级（一次性向量化采样；1 - u 落在 (0, 1]，避免 log(0)）
+    u = 1.0 - _rng.random(n_nodes)
+    levels = (-np.log(u) / np.log(1/ml)).astype(int)
 
     # 统计
-    level_counts = {}
-    for level in levels:
-        level_counts[level] = level_counts.get(level, 0) + 1
+    level_counts = dict(enumerate(np.bincount(levels)))
 
     # 理论分布
     theoretical_levels = range(max_level + 1)
@@ -243,8 +297,8 @@ def visualize_level_distribution(max_level=10, ml=0.5, n_nodes=10000):
     ax2.grid(True, alpha=0.3)
 
     plt.tight_layout()
-    plt.savefig('level_distribution.png', dpi=300, bbox_inches='tight')
-    plt.show()
+    plt.savefig('level_distribution.png', dpi=DPI, bbox_inches='tight')
+    _show_or_close(fig)
 
 
 def visualize_performance_comparison():
@@ -281,8 +335,8 @@ def visualize_performance_comparison():
     ax3.grid(True, alpha=0.3, axis='y')
 
     plt.tight_layout()
-    plt.savefig('performance_comparison.png', dpi=300, bbox_inches='tight')
-    plt.show()
+    plt.savefig('performance_comparison.png', dpi=DPI, bbox_inches='tight')
+    _show_or_close(fig)
 
 
 def visualize_recall_vs_latency():
@@ -297,10 +351,11 @@ def visualize_recall_vs_latency():
     ax.plot(latencies, recalls, 'o-', linewidth=3, markersize=10,
            color='steelblue', label='HNSW')
 
-    # 标注 ef 值
-    for ef, r, l in zip(ef_values, recalls, latencies):
-        ax.annotate(f'ef={ef}', (l, r),
-                   textcoords="offset points", xytext=(0,10), ha='center',
+    # 标注 ef 值（标签文本预先格式化，偏移量对所有点相同）
+    labels = [f'ef={ef}' for ef in ef_values]
+    for label, point in zip(labels, zip(latencies, recalls)):
+        ax.annotate(label, point,
+                   textcoords="offset points", xytext=(0, 10), ha='center',
                    fontsize=10, fontweight='bold')
 
     ax.set_xlabel('Search Latency (ms)', fontsize=14)
@@ -314,8 +369,8 @@ def visualize_recall_vs_latency():
                    label='Ideal Region')
 
     plt.tight_layout()
-    plt.savefig('recall_vs_latency.png', dpi=300, bbox_inches='tight')
-    plt.show()
+    plt.savefig('recall_vs_latency.png', dpi=DPI, bbox_inches='tight')
+    _show_or_close(fig)
 
 
 def visualize_quantization_impact():
@@ -344,8 +399,8 @@ def visualize_quantization_impact():
     ax2.grid(True, alpha=0.3, axis='y')
 
     plt.tight_layout()
-    plt.savefig('quantization_impact.png', dpi=300, bbox_inches='tight')
-    plt.show()
+    plt.savefig('quantization_impact.png', dpi=DPI, bbox_inches='tight')
+    _show_or_close(fig)
 
 
 if __name__ == '__main__':